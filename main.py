@@ -1,8 +1,10 @@
 import argparse
 import asyncio
 import logging
-import sys
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 from automation_server_client import AutomationServer, Workqueue, WorkItemError, Credential
 from nexus_database_client import NexusDatabaseClient
@@ -10,59 +12,173 @@ from kmd_nexus_client import NexusClientManager
 from odk_tools.tracking import Tracker
 from odk_tools.reporting import Reporter
 from process.config import get_excel_mapping, load_excel_mapping
-from kmd_nexus_client.tree_helpers import (
-    filter_by_path, filter_by_predicate,    
-)
+from kmd_nexus_client.tree_helpers import filter_by_path
 from datetime import date, datetime
-from dateutil.parser import parse
 from zoneinfo import ZoneInfo
 
 nexus: NexusClientManager
-nexus_database_client: NexusDatabaseClient
+nexus_database_credential: Credential
 tracker: Tracker
 reporter: Reporter
+tracker_lock = threading.Lock()
 
 proces_navn = "Påmindelse om afregning af indsatser (voksne)"
+CPH_TZ = ZoneInfo("Europe/Copenhagen")
+INDSATS_STI = "/*/*/Indsatser/basketGrantReference"
 logger = logging.getLogger(proces_navn)
 
-async def populate_queue(workqueue: Workqueue):
-    regler = get_excel_mapping()
-    for organisation in regler["Organisationer"]:
-        modificerede_indsatser = nexus_database_client.get_modified_grants_by_organisation_name(organisation_name=organisation,  days_back=4, workflow_states=regler["Status på indsats"])
-
-        for indsats in modificerede_indsatser:
-            data = {
-                "cpr": indsats["business_key"],
-                "indsats_id": indsats["id"],
-                "indsats_navn": indsats["name"],
-                "sidste_aendring": indsats["last_state_change"].strftime("%d-%m-%Y %H:%M:%S"),
-            }
-                        
-            workqueue.add_item(data=data, reference=f"{indsats['id']}")
-
-async def process_workqueue(workqueue: Workqueue):
-    regler = get_excel_mapping()
-    for item in workqueue:
-        with item:            
-            try:
-                data = item.data
-                indsats = hent_indsats(item_data=data)
-                
-                if not indsats:
-                    return None
-                
-                white_listed_leverandør = kontroller_leverandør(indsats=indsats, regler=regler)
-
-                if not white_listed_leverandør:
-                    continue
-
-                opret_opgave(indsats=indsats, item_data=data)
-            except WorkItemError as e:
-                logger.error(f"Error processing item: {data}. Error: {e}")
-                item.fail(str(e))
-
-def hent_indsats(item_data: dict) -> dict|None:
-    borger = nexus.borgere.hent_borger(item_data["cpr"])
+@dataclass(slots=True)
+class CprOpslag:
+    lås: threading.Lock = field(default_factory=threading.Lock)
+    hentet: bool = False
+    grant_referencer: list|None = None
+
+# Grant-referencer pr. cpr for den igangværende kørsel
+referencer_cache: dict[str, CprOpslag] = {}
+# Én lås pr. indsats, så historik-tjek og oprettelse af opgave ikke overlapper for samme indsats
+indsats_låse: dict[int, threading.Lock] = {}
+
+@dataclass(slots=True)
+class ItemData:
+    cpr: str
+    indsats_id: int
+    indsats_navn: str
+    sidste_aendring: datetime
+
+    @classmethod
+    def fra_dict(cls, data: dict) -> "ItemData":
+        return cls(
+            cpr=data["cpr"],
+            indsats_id=data["indsats_id"],
+            indsats_navn=data["indsats_navn"],
+            sidste_aendring=til_cph_tid(datetime.fromisoformat(data["sidste_aendring"])),
+        )
+
+def opret_database_client() -> NexusDatabaseClient:
+    return NexusDatabaseClient(
+        host = nexus_database_credential.data["hostname"],
+        port = nexus_database_credential.data["port"],
+        user = nexus_database_credential.username,
+        password = nexus_database_credential.password,
+        database = nexus_database_credential.data["database_name"],
+    )
+
+async def populate_queue(workqueue: Workqueue, regler: dict, antal_forbindelser: int = 8):
+    loop = asyncio.get_running_loop()
+
+    # MySQL-forbindelser kan ikke deles mellem tråde, så hver forespørgsel får sin egen klient
+    def hent_modificerede_indsatser(organisation: str) -> list[dict]:
+        return opret_database_client().get_modified_grants_by_organisation_name(
+            organisation_name=organisation,
+            days_back=4,
+            workflow_states=regler["Status på indsats"],
+        )
+
+    pending: list[tuple[dict, str]] = []
+
+    async def tilføj_items():
+        await asyncio.gather(
+            *[asyncio.to_thread(workqueue.add_item, data=data, reference=reference) for data, reference in pending]
+        )
+        pending.clear()
+
+    with ThreadPoolExecutor(max_workers=antal_forbindelser) as pool:
+        hentninger = asyncio.as_completed(
+            [loop.run_in_executor(pool, hent_modificerede_indsatser, organisation) for organisation in regler["Organisationer"]]
+        )
+
+        for hentning in hentninger:
+            for indsats in await hentning:
+                data = {
+                    "cpr": indsats["business_key"],
+                    "indsats_id": indsats["id"],
+                    "indsats_navn": indsats["name"],
+                    "sidste_aendring": indsats["last_state_change"].isoformat(),
+                }
+                            
+                pending.append((data, f"{indsats['id']}"))
+
+                if len(pending) >= 100:
+                    await tilføj_items()
+
+    await tilføj_items()
+
+async def process_workqueue(workqueue: Workqueue, regler: dict, antal_workers: int = 16):
+    referencer_cache.clear()
+    indsats_låse.clear()
+    loop = asyncio.get_running_loop()
+    items = iter(workqueue)
+    items_lock = threading.Lock()
+
+    # Hver worker henter selv sit næste item, så der ikke tages flere items, end der behandles
+    def næste_item():
+        with items_lock:
+            return next(items, None)
+
+    def worker():
+        while (item := næste_item()) is not None:
+            behandl_item(item=item, regler=regler)
+
+    with ThreadPoolExecutor(max_workers=antal_workers) as pool:
+        await asyncio.gather(*[loop.run_in_executor(pool, worker) for _ in range(antal_workers)])
+
+def behandl_item(item, regler: dict) -> None:
+    with item:            
+        data = item.data
+
+        try:
+            item_data = ItemData.fra_dict(data)
+            indsats = hent_indsats(item_data=item_data)
+            
+            if not indsats:
+                item.fail("Indsats ikke fundet")
+                return None
+            
+            white_listed_leverandør = kontroller_leverandør(indsats=indsats, regler=regler)
+
+            if not white_listed_leverandør:
+                return None
+
+            with indsats_låse.setdefault(indsats["id"], threading.Lock()):
+                opret_opgave(indsats=indsats, item_data=item_data)
+        except WorkItemError as e:
+            logger.error(f"Error processing item: {data}. Error: {e}")
+            item.fail(str(e))
+        except Exception as e:
+            logger.exception(f"Unexpected error processing item: {data}")
+            item.fail(str(e))
+
+def hent_indsats(item_data: ItemData) -> dict|None:
+    grant_referencer = hent_indsats_referencer(item_data.cpr)
+
+    if grant_referencer is None:
+        return None
+
+    indsats_reference = find_indsats_reference(grant_referencer, item_data.indsats_id)
+
+    if not indsats_reference:
+        return None
+
+    indsats = nexus.indsatser.hent_indsats(indsats_reference)
+
+    return indsats
+
+# Flere items kan dele samme borger, så referencerne hentes og filtreres kun én gang pr. cpr.
+# Samtidige workers venter på den første hentning frem for at gentage den. Fejler hentningen,
+# prøver næste item for samme cpr igen.
+def hent_indsats_referencer(cpr: str) -> list|None:
+    # dict.setdefault er atomisk, så alle workers får samme opslag for et cpr
+    opslag = referencer_cache.setdefault(cpr, CprOpslag())
+
+    with opslag.lås:
+        if not opslag.hentet:
+            opslag.grant_referencer = hent_og_filtrer_referencer(cpr)
+            opslag.hentet = True
+
+    return opslag.grant_referencer
+
+def hent_og_filtrer_referencer(cpr: str) -> list|None:
+    borger = nexus.borgere.hent_borger(cpr)
 
     if not borger:
         return None
@@ -74,25 +190,19 @@ def hent_indsats(item_data: dict) -> dict|None:
             f"Kunne ikke finde -Alt for borger {borger['patientIdentifier']['identifier']}"
         )
 
-    indsats_referencer = nexus.borgere.hent_referencer(visning=pathway)            
+    indsats_referencer = nexus.borgere.hent_referencer(visning=pathway)
 
-    filtrerede_indsats_referencer = filter_by_path(
+    return list(filter_by_path(
         indsats_referencer,
-        path_pattern="/*/*/Indsatser/basketGrantReference",
+        path_pattern=INDSATS_STI,
         active_pathways_only=False,
-    )
-    
-    indsatser = filter_by_predicate(
-        roots=filtrerede_indsats_referencer,
-        predicate=lambda x: x["grantId"] == item_data["indsats_id"]
-    )
-
-    if not indsatser:
-        return None
+    ))
 
-    indsats = nexus.indsatser.hent_indsats(indsatser[0])
-
-    return indsats
+def find_indsats_reference(grant_referencer: list, indsats_id: int) -> dict|None:
+    return next(
+        (reference for reference in grant_referencer if reference["grantId"] == indsats_id),
+        None,
+    )
 
 def kontroller_leverandør(indsats: dict, regler: dict) -> bool:
     felt_værdier = nexus.indsatser.hent_indsats_elementer(indsats=indsats)
@@ -105,20 +215,25 @@ def kontroller_leverandør(indsats: dict, regler: dict) -> bool:
 
     return True
 
-def opret_opgave(indsats: dict, item_data: dict) -> None:
+# Både Nexus' og databasens tidspunkter læses som dansk tid, så de sammenlignes ens
+def til_cph_tid(tidspunkt: datetime) -> datetime:
+    return tidspunkt.replace(tzinfo=CPH_TZ)
+
+def opret_opgave(indsats: dict, item_data: ItemData) -> None:
     opgaver = nexus.opgaver.hent_opgave_historik(objekt=indsats)
-    indsats_ændring = datetime.strptime(item_data["sidste_aendring"], "%d-%m-%Y %H:%M:%S")
-    indsats_ændring = indsats_ændring.replace(tzinfo=ZoneInfo("Europe/Copenhagen"))
 
     if opgaver is not None:
         for opgave in opgaver:
-            opgave_ændring = parse(opgave["lastStateChangeDate"])
-            opgave_ændring = opgave_ændring.replace(tzinfo=ZoneInfo("Europe/Copenhagen"))
-            
-            if opgave["type"]["name"] == "Indsatser til økonomi - voksne":
-                if (opgave_ændring > indsats_ændring or
-                opgave["workflowState"]["name"] == "Aktiv"):
-                    return None
+            if opgave["type"]["name"] != "Indsatser til økonomi - voksne":
+                continue
+
+            if opgave["workflowState"]["name"] == "Aktiv":
+                return None
+
+            opgave_ændring = til_cph_tid(datetime.fromisoformat(opgave["lastStateChangeDate"]))
+
+            if opgave_ændring > item_data.sidste_aendring:
+                return None
     
     try:
         nexus.opgaver.opret_opgave(
@@ -136,7 +251,13 @@ def opret_opgave(indsats: dict, item_data: dict) -> None:
     except Exception as e:
         raise WorkItemError(f"Fejl ved oprettelse af opgave: {e}")    
     
-    tracker.track_task(proces_navn)
+    with tracker_lock:
+        tracker.track_task(proces_navn)
+
+async def hent_credentials(*navne: str) -> list[Credential]:
+    return await asyncio.gather(
+        *[asyncio.to_thread(Credential.get_credential, navn) for navn in navne]
+    )
 
 if __name__ == "__main__":
     logging.basicConfig(
@@ -166,26 +287,35 @@ if __name__ == "__main__":
 
     # Load POF mapping data once on startup
     load_excel_mapping(args.excel_file)
+    regler = get_excel_mapping()
+
+    logger = logging.getLogger(__name__)
 
-    nexus_credential = Credential.get_credential("KMD Nexus - produktion")
-    nexus_database_credential = Credential.get_credential("KMD Nexus - database")
-    xflow_credential = Credential.get_credential("Xflow - produktion")
-    tracking_credential = Credential.get_credential("Odense SQL Server")
-    reporting_credential = Credential.get_credential("RoboA")
+    # Queue management
+    if args.queue:
+        nexus_database_credential = Credential.get_credential("KMD Nexus - database")
+
+        workqueue.clear_workqueue("new")
+        asyncio.run(populate_queue(workqueue, regler))
+        exit(0)
+
+    (
+        nexus_credential,
+        xflow_credential,
+        tracking_credential,
+        reporting_credential,
+    ) = asyncio.run(hent_credentials(
+        "KMD Nexus - produktion",
+        "Xflow - produktion",
+        "Odense SQL Server",
+        "RoboA",
+    ))
 
     nexus = NexusClientManager(
         client_id=nexus_credential.username,
         client_secret=nexus_credential.password,
         instance=nexus_credential.data["instance"],
     )    
-    
-    nexus_database_client = NexusDatabaseClient(
-        host = nexus_database_credential.data["hostname"],
-        port = nexus_database_credential.data["port"],
-        user = nexus_database_credential.username,
-        password = nexus_database_credential.password,
-        database = nexus_database_credential.data["database_name"],
-    )
 
     tracker = Tracker(
         username=tracking_credential.username, 
@@ -197,13 +327,5 @@ if __name__ == "__main__":
         password=reporting_credential.password
     )
 
-    logger = logging.getLogger(__name__)
-
-    # Queue management
-    if "--queue" in sys.argv:
-        workqueue.clear_workqueue("new")
-        asyncio.run(populate_queue(workqueue))
-        exit(0)
-
     # Process workqueue
-    asyncio.run(process_workqueue(workqueue))
+    asyncio.run(process_workqueue(workqueue, regler))
@@ -1,7 +1,10 @@
-from typing import Dict, List
+from typing import Dict, FrozenSet, List
 from openpyxl import load_workbook
 
-def get_excel_mapping() -> Dict[str, List[str]]:
+# Kolonner der kun bruges til opslag gemmes som frozenset
+opslags_kolonner = {"Irrelevante leverandører"}
+
+def get_excel_mapping() -> Dict[str, List[str] | FrozenSet[str]]:
     """Henter POF-mapping fra Martin og Sofies regneark"""
     global excel_mappings
     if not excel_mappings:
@@ -20,7 +23,7 @@ def load_excel_mapping(file_path: str):
             raise ValueError("Worksheet could not be loaded")
 
         # Initialize mapping dictionary
-        mapping: Dict[str, List[str]] = {}
+        mapping: Dict[str, List[str] | FrozenSet[str]] = {}
 
         # Get header row to identify POF columns (row 1)
         header_row = worksheet[1]
@@ -37,7 +40,7 @@ def load_excel_mapping(file_path: str):
                 cell_value = row[0].value
                 if cell_value and str(cell_value).strip():  # Non-blank cells only
                     items.append(str(cell_value).strip())
-            mapping[header] = items
+            mapping[header] = frozenset(items) if header in opslags_kolonner else items
 
         excel_mappings = mapping
 